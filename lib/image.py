@@ -1,26 +1,174 @@
-import os.path
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
 from math import sqrt
-from random import randint
+from multiprocessing import shared_memory
 
+import numpy as np
 import PIL.Image as Image
 
 from lib import utils
 
 
+# Averages kept for every block: one per alg type, plus color variance
+AVERAGE_KEYS = ('l', 'h', 's', 'v', 'r', 'g', 'b', 'variance')
+
+# Number of block rows build_average_list processes at a time
+BAND_ROWS = 4
+
+# Output images are saved on background threads. Encoding and writing a TIFF
+# mostly runs in Pillow's C code, which releases the GIL.
+_SAVE_POOL = ThreadPoolExecutor(max_workers=2)
+
+# Number of output images that can be waiting to be saved at once
+MAX_PENDING_SAVES = 4
+
+# Tiles are built on a thread pool shared by everything in the process. It's
+# created on first use, sized to this process's share of the CPUs.
+_TILE_POOL = None
+_tile_threads = os.cpu_count() or 1
+
+# Array versions of the Image.transpose methods used to randomly flip and
+# rotate blocks: FLIP_LEFT_RIGHT, FLIP_TOP_BOTTOM and ROTATE_90
+TRANSPOSES = (np.fliplr, np.flipud, np.rot90)
+
+# Most memory the finished tiles of one source image may take up, split
+# between the processes rendering at the same time. The cache starts over
+# once it's full.
+TILE_CACHE_BYTES = 256 << 20
+_tile_cache_bytes = TILE_CACHE_BYTES
+
+
+def _compute_boundaries(num, block, offsets):
+    """
+    Calculates block boundaries along one axis. Boundary k sits at k * block,
+    moved by the offset for k, and each block ends where the next one starts.
+
+    :param num: Number of blocks along the axis
+    :param block: Block size along the axis
+    :param offsets: List of offsets, one longer than num
+    :return: Array of num + 1 boundaries
+    """
+    return np.arange(num + 1) * block + np.asarray(offsets, dtype=int)
+
+
+def _sum_blocks(values, row_bounds, col_bounds, dtype=None):
+    """
+    Sums an array of per-pixel values over each block.
+
+    :param values: Array of shape (height, width, channels)
+    :param row_bounds: Row boundaries, one longer than the number of rows
+    :param col_bounds: Column boundaries, one longer than the number of columns
+    :param dtype: Accumulator type, or None to use the array's own type
+    :return: Array of shape (rows, cols, channels) containing the block sums
+    """
+    sums = np.add.reduceat(values, row_bounds[:-1], axis=0, dtype=dtype)
+    return np.add.reduceat(sums, col_bounds[:-1], axis=1)
+
+
+def _block_colors(pixels, row_bounds, col_bounds):
+    """
+    Finds the unique colors in each block, like calling getcolors on every
+    block. Every pixel is tagged with its block number and packed color, so a
+    single np.unique over the whole image finds each (block, color) pair once.
+
+    :param pixels: Array of shape (height, width, 3) containing r, g, b values
+    :param row_bounds: Row boundaries, one longer than the number of rows
+    :param col_bounds: Column boundaries, one longer than the number of columns
+    :return: A tuple containing the block number, (r, g, b) array and pixel
+             count of every unique (block, color) pair
+    """
+    num_cols = len(col_bounds) - 1
+    block_rows = np.repeat(np.arange(len(row_bounds) - 1, dtype=np.int64), np.diff(row_bounds))
+    block_cols = np.repeat(np.arange(num_cols, dtype=np.int64), np.diff(col_bounds))
+    blocks = block_rows[:, np.newaxis] * num_cols + block_cols
+
+    colors = pixels.astype(np.int64)
+    colors = (colors[..., 0] << 16) | (colors[..., 1] << 8) | colors[..., 2]
+    keys, counts = np.unique((blocks << 24) | colors, return_counts=True)
+    return _split_keys(keys) + (counts,)
+
+
+def _split_keys(keys):
+    """
+    Splits packed (block << 24) | color keys back into their parts.
+
+    :param keys: Array of packed keys
+    :return: A tuple containing the block numbers and (r, g, b) array
+    """
+    rgb = np.stack([(keys >> 16) & 0xff, (keys >> 8) & 0xff, keys & 0xff], axis=-1)
+    return keys >> 24, rgb
+
+
+def _merge_blocks(rgb_sums, blocks, colors, counts, factor):
+    """
+    Merges block data into blocks factor times as large in each direction.
+    The unique colors of each merged block are found from the colors of the
+    blocks inside it, so no pixels are looked at again.
+
+    :param rgb_sums: Array of shape (rows, cols, 3) containing the block sums
+    :param blocks: Block number of every unique (block, color) pair
+    :param colors: (r, g, b) array of every unique (block, color) pair
+    :param counts: Pixel count of every unique (block, color) pair
+    :param factor: Number of blocks merged along each axis
+    :return: The same four values for the merged blocks
+    """
+    rows, cols = rgb_sums.shape[:2]
+    rgb_sums = rgb_sums.reshape(rows // factor, factor, cols // factor, factor, 3).sum(axis=(1, 3))
+
+    # Renumber every pair with the merged block it falls in, then combine
+    # pairs that now share a block and color
+    merged = (blocks // cols // factor) * (cols // factor) + (blocks % cols) // factor
+    packed = (colors[:, 0] << 16) | (colors[:, 1] << 8) | colors[:, 2]
+    keys, inverse = np.unique((merged << 24) | packed, return_inverse=True)
+    counts = np.bincount(inverse.ravel(), weights=counts).astype(np.int64)
+    return (rgb_sums,) + _split_keys(keys) + (counts,)
+
+
+def set_process_count(processes):
+    """
+    Splits the CPUs and the tile cache budget between the processes
+    rendering at the same time, so each process only gets its share. Call
+    before building any tiles.
+
+    :param processes: Number of processes rendering at the same time
+    :return: Nothing
+    """
+    global _tile_threads, _tile_cache_bytes
+    _tile_threads = max(1, (os.cpu_count() or 1) // processes)
+    _tile_cache_bytes = TILE_CACHE_BYTES // processes
+
+
+def _tile_pool():
+    """
+    Returns the process's tile pool, creating it the first time.
+
+    :return: The tile pool
+    """
+    global _TILE_POOL
+    if _TILE_POOL is None:
+        _TILE_POOL = ThreadPoolExecutor(max_workers=_tile_threads)
+    return _TILE_POOL
+
+
 class SourceImage(object):
     """
     Class that defines and processes the source image and destination images,
     each considered "sources" as opposed to "output."
     """
-    def __init__(self, image, is_non_uniform, is_detail):
+    def __init__(self, image, is_non_uniform, is_detail, pixels=None):
         """
         Init method.
 
         :param image: The Image object
         :param is_non_uniform: Boolean indicating non-uniformity
         :param is_detail: Boolean indicating presence of detail option
+        :param pixels: Pixel array already converted from the Image, if any
         """
         self._image = image
+        if pixels is None:
+            pixels = np.asarray(image.convert("RGB"))
+        self._pixels = pixels
         self._is_non_uniform = is_non_uniform
         self._is_detail = is_detail
         self._block_size = 0
@@ -31,8 +179,14 @@ class SourceImage(object):
         self._num_blocks = 0
         self._row_list = []
         self._col_list = []
-        self._avg_list = []
+        self._row_bounds = None
+        self._col_bounds = None
+        self._avg = {}
         self._avg_lut = []
+        self._shm_name = None
+        self._shm = None
+        self._tiles = {}
+        self._tile_bytes = 0
 
         self._coord_list = []
 
@@ -61,6 +215,75 @@ class SourceImage(object):
         """
         return cls(image, is_non_uniform, is_detail)
 
+    @classmethod
+    def from_source_image(cls, source_image, is_non_uniform=False, is_detail=False):
+        """
+        Class method for creating instance that shares another instance's
+        Image and pixels, so the image isn't converted or copied again.
+
+        :param source_image: The SourceImage to share with
+        :param is_non_uniform: Boolean indicating non-uniformity
+        :param is_detail: Boolean indicating presence of detail option
+        :return: Class instance
+        """
+        return cls(source_image.image, is_non_uniform, is_detail, source_image.pixels)
+
+    def __getstate__(self):
+        """
+        Pickles the image for a worker process. Workers only need the block
+        data and the pixels, so the Image is left out. Shared pixels are
+        passed by name instead of by value.
+
+        :return: Dict of attributes to pickle
+        """
+        state = self.__dict__.copy()
+        state['_image'] = None
+        state['_shm'] = None
+        state['_tiles'] = {}
+        state['_tile_bytes'] = 0
+        if self._shm_name is not None:
+            state['_pixels'] = (self._pixels.shape, self._pixels.dtype.str)
+        return state
+
+    def __setstate__(self, state):
+        """
+        Unpickles the image in a worker process, attaching to shared pixels.
+
+        :param state: Dict of pickled attributes
+        :return: Nothing
+        """
+        self.__dict__.update(state)
+        if self._shm_name is not None:
+            shape, dtype = self._pixels
+            try:
+                shm = shared_memory.SharedMemory(name=self._shm_name, track=False)
+            except TypeError:
+                # Attaching can't opt out of tracking before Python 3.13
+                shm = shared_memory.SharedMemory(name=self._shm_name)
+
+            # Hold on to the block for as long as the pixels. It's unmapped as
+            # soon as it's garbage collected.
+            self._shm = shm
+            self._pixels = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+
+    def share_pixels(self, *images):
+        """
+        Moves the pixels into shared memory, so worker processes attach to
+        them instead of each receiving a copy.
+
+        :param images: Other images created with from_source_image, which
+                       are moved over to the same shared pixels
+        :return: The SharedMemory block. The caller unlinks it when done.
+        """
+        shm = shared_memory.SharedMemory(create=True, size=self._pixels.nbytes)
+        pixels = np.ndarray(self._pixels.shape, dtype=self._pixels.dtype, buffer=shm.buf)
+        pixels[:] = self._pixels
+        for image in (self,) + images:
+            image._pixels = pixels
+            image._shm_name = shm.name
+            image._shm = shm
+        return shm
+
     def calculate_block_vars(self, user_block_size=0, width_override=0, height_override=0):
         """
         For source image: Calculates block size for src image of any size, to
@@ -88,11 +311,11 @@ class SourceImage(object):
             self._block_width = user_block_size
             self._block_height = user_block_size
             if width_override > 0 and height_override > 0:
-                self._num_cols = int(width_override / user_block_size)
-                self._num_rows = int(height_override / user_block_size)
+                self._num_cols = width_override // user_block_size
+                self._num_rows = height_override // user_block_size
             else:
-                self._num_cols = int(width / user_block_size)
-                self._num_rows = int(height / user_block_size)
+                self._num_cols = width // user_block_size
+                self._num_rows = height // user_block_size
 
             # Build a list of offsets for block width and height. If we're
             # not using uneven blocks, we'll just set them all to 0.
@@ -102,10 +325,10 @@ class SourceImage(object):
                 # 2/3 of user block size. Create the lists one longer than
                 # needed because we're looking at boundaries, not the blocks
                 # themselves.
-                lower = -user_block_size / 3
-                upper = user_block_size / 3
-                self._row_list = [randint(lower, upper) for r in range(self._num_rows + 1)]
-                self._col_list = [randint(lower, upper) for c in range(self._num_cols + 1)]
+                lower = -(user_block_size // 3)
+                upper = user_block_size // 3
+                self._row_list = np.random.randint(lower, upper + 1, size=self._num_rows + 1)
+                self._col_list = np.random.randint(lower, upper + 1, size=self._num_cols + 1)
 
                 # We won't increment the first and last row or column,
                 # otherwise we'll go past the edge of the image.
@@ -129,8 +352,8 @@ class SourceImage(object):
             cols = aspect * rows
             rows = int(round(rows))
             cols = int(round(cols))
-            self._block_width = int(width / cols)
-            self._block_height = int(height / rows)
+            self._block_width = width // cols
+            self._block_height = height // rows
             self._num_rows = rows
             self._num_cols = cols
 
@@ -143,99 +366,147 @@ class SourceImage(object):
         self._num_blocks = self._num_rows * self._num_cols
         self._block_size = self._block_width * self._block_height
 
+        # Block boundaries never change after this, so work them out once
+        self._row_bounds = _compute_boundaries(self._num_rows, self._block_height, self._row_list)
+        self._col_bounds = _compute_boundaries(self._num_cols, self._block_width, self._col_list)
+
+        # One array per alg type (plus color variance) to hold the averages,
+        # indexed by block. Averages are scaled to the number of source
+        # blocks (about 256), so 16 bits is plenty.
+        self._avg = {k: np.empty(self._num_blocks, dtype=np.int16) for k in AVERAGE_KEYS}
+
     def build_coordinate_list(self):
-        for i in range(self._num_blocks):
-            col = int(i % self._num_cols)
-            row = int(i / self._num_cols)
-            start_x = col * self._block_width
-            start_y = row * self._block_height
-            end_x = start_x + self._block_width
-            end_y = start_y + self._block_height
-            self._coord_list.append((start_x, start_y, end_x, end_y))
+        """
+        Builds a list of bounding boxes, one for each block, ignoring any
+        offsets.
 
-    def build_average_list(self, max_value):
+        :return: Nothing
+        """
+        rows, cols = np.divmod(np.arange(self._num_blocks), self._num_cols)
+        start_x = cols * self._block_width
+        start_y = rows * self._block_height
+        end_x = start_x + self._block_width
+        end_y = start_y + self._block_height
+        self._coord_list.extend(zip(start_x.tolist(), start_y.tolist(), end_x.tolist(), end_y.tolist()))
+
+    def build_average_list(self, max_value, coarser=(), channels='lhsvrgb'):
         """
         Builds a list of average l h s v r g b, one for each block.
 
+        Images in coarser get their averages built at the same time. Each of
+        their blocks must be made of whole blocks of this image (uniform
+        blocks over the same area, with a block size that is a multiple of
+        this one).
+
+        Counting the colors in every block is most of the work, and is only
+        needed for h, s and v, and for color variance with the detail
+        option. If none of those are needed, they are left at 0.
+
+        :param max_value: Maximum value used to scale the averages
+        :param coarser: Other images of the same picture with larger blocks
+        :param channels: Alg types the averages will be used for
+        :return: Nothing
+        """
+        row_bounds = self._row_bounds
+        col_bounds = self._col_bounds
+        count_colors = self._is_detail is True or any(t in channels for t in 'hsv')
+        rgb_sums = []
+        band_colors = []
+
+        # Work through the image in bands of a few block rows so that each
+        # band's pixels, and the temporary arrays built from them, stay in
+        # cache rather than streaming the whole image through memory.
+        for band in range(0, self._num_rows, BAND_ROWS):
+            band_bounds = row_bounds[band:band + BAND_ROWS + 1]
+            pixels = self._pixels[band_bounds[0]:band_bounds[-1], :col_bounds[-1]]
+            band_bounds = band_bounds - band_bounds[0]
+
+            # Sum the r, g and b values of every block with two reductions
+            # (rows, then columns). Each block ends where the next one begins,
+            # so the boundaries double as the reduceat indices. The offsets
+            # will be all 0's if uniform blocks are used. Slicing the pixel
+            # array is a view, so no block is copied.
+            rgb_sums.append(_sum_blocks(pixels, band_bounds, col_bounds, np.int64))
+
+            # Find the unique colors in each block of the band
+            if count_colors is True:
+                blocks, colors, counts = _block_colors(pixels, band_bounds, col_bounds)
+                band_colors.append((blocks + band * self._num_cols, colors, counts))
+
+        rgb_sums = np.concatenate(rgb_sums)
+        if count_colors is True:
+            blocks, colors, counts = (np.concatenate(a) for a in zip(*band_colors))
+        else:
+            blocks = np.zeros(0, dtype=np.int64)
+            colors = np.zeros((0, 3), dtype=np.int64)
+            counts = np.zeros(0, dtype=np.int64)
+        self._set_averages(rgb_sums, blocks, colors, counts, max_value)
+
+        # Build the larger blocks out of this image's blocks
+        for image in coarser:
+            factor = image._block_height // self._block_height
+            image._set_averages(*_merge_blocks(rgb_sums, blocks, colors, counts, factor),
+                                max_value=max_value)
+
+    def _set_averages(self, rgb_sums, blocks, colors, counts, max_value):
+        """
+        Calculates the block averages from summed colors and the unique colors
+        in each block.
+
+        :param rgb_sums: Array of shape (rows, cols, 3) containing the block sums
+        :param blocks: Block number of every unique (block, color) pair
+        :param colors: (r, g, b) array of every unique (block, color) pair
+        :param counts: Pixel count of every unique (block, color) pair
         :param max_value: Maximum value used to scale the averages
         :return: Nothing
         """
-        # Build the list of average block hues, values, or saturations,
-        # then sort
-        for i in range(self._num_blocks):
-
-            col = int(i % self._num_cols)
-            row = int(i / self._num_cols)
-            start_x = col * self._block_width
-            start_y = row * self._block_height
-            end_x = start_x + self._block_width
-            end_y = start_y + self._block_height
-
-            # Calculate block uniformity. We have to look at the current
-            # value and the next one, which correspond to the start and
-            # end values respectively. The increments will be all 0's if
-            # uniform blocks are used.
-            start_x += self._col_list[col]
-            end_x += self._col_list[col + 1]
-            start_y += self._row_list[row]
-            end_y += self._row_list[row + 1]
-            current_block_size = (end_x - start_x) * (end_y - start_y)
-
-            # Crop to the bounding box to create the block, then process
-            bounding_box = (start_x, start_y, end_x, end_y)
-            block = self._image.crop(bounding_box)
-            colors = block.getcolors(current_block_size)
-            rsum, gsum, bsum = 0, 0, 0
-            hsum, ssum, vsum = 0.0, 0.0, 0.0
-
-            # Get per-pixel values and keep running total for each alg type
-            for item in colors:
-                r = item[1][0]
-                g = item[1][1]
-                b = item[1][2]
-                rsum += r * item[0]
-                gsum += g * item[0]
-                bsum += b * item[0]
-                h, s, v = utils.rgb_to_hsv(r, g, b)  # slower here but more accurate
-                hsum += h * item[0]
-                ssum += s * item[0]
-                vsum += v * item[0]
-
-            # Calculate full block averages here
-            avg_r = float(rsum) / float(current_block_size)
-            avg_g = float(gsum) / float(current_block_size)
-            avg_b = float(bsum) / float(current_block_size)
-            avg_l = (avg_r * 0.299) + (avg_g * 0.587) + (avg_b * 0.114)
-            avg_h = float(hsum) / float(current_block_size)
-            avg_s = float(ssum) / float(current_block_size)
-            avg_v = float(vsum) / float(current_block_size)
-
-            # Scale all to 0, max_value and convert to int
-            avg_l = int((avg_l / 255.0) * max_value)
-            avg_h = int((avg_h / 359.0) * max_value)
-            avg_s = int(avg_s * max_value)
-            avg_v = int((avg_v / 255.0) * max_value)
-            avg_r = int((avg_r / 255.0) * max_value)
-            avg_g = int((avg_g / 255.0) * max_value)
-            avg_b = int((avg_b / 255.0) * max_value)
-
-            # Calculate color variance in block, scale of 0 to 1, based on
-            # actual number of unique colors in block
-            variance = int(float(len(colors)) / float(current_block_size) * 10.0)
-
-            # Save average for each alg type in a dict for the block. Also
-            # save a scaled count of the number of colors present per block
-            # (used for detail option).
-            avg_dict = {}
-            avg_dict['l'] = avg_l
-            avg_dict['h'] = avg_h
-            avg_dict['s'] = avg_s
-            avg_dict['v'] = avg_v
-            avg_dict['r'] = avg_r
-            avg_dict['g'] = avg_g
-            avg_dict['b'] = avg_b
-            avg_dict['variance'] = variance
-            self._avg_list.append(avg_dict)
+        # Convert only the unique colors to hsv, weighting each by the number
+        # of pixels it covers. Per-pixel values are more accurate than
+        # converting the block averages.
+        hsv = utils.rgb_to_hsv_array(colors)
+        hsv_sums = np.stack([np.bincount(blocks, weights=c * counts, minlength=self._num_blocks)
+                             for c in hsv], axis=-1)
+        hsv_sums = hsv_sums.reshape(self._num_rows, self._num_cols, 3)
+
+        # Count the unique colors in each block and the number of pixels in
+        # each block
+        num_colors = np.bincount(blocks, minlength=self._num_blocks)
+        num_colors = num_colors.reshape(self._num_rows, self._num_cols)
+        sizes = np.outer(np.diff(self._row_bounds), np.diff(self._col_bounds))
+
+        # Calculate full block averages here
+        avg_r = rgb_sums[..., 0] / sizes
+        avg_g = rgb_sums[..., 1] / sizes
+        avg_b = rgb_sums[..., 2] / sizes
+        avg_l = (avg_r * 0.299) + (avg_g * 0.587) + (avg_b * 0.114)
+        avg_h = hsv_sums[..., 0] / sizes
+        avg_s = hsv_sums[..., 1] / sizes
+        avg_v = hsv_sums[..., 2] / sizes
+
+        # Scale all to 0, max_value and convert to int
+        avg_l = ((avg_l / 255.0) * max_value).astype(int)
+        avg_h = ((avg_h / 359.0) * max_value).astype(int)
+        avg_s = (avg_s * max_value).astype(int)
+        avg_v = ((avg_v / 255.0) * max_value).astype(int)
+        avg_r = ((avg_r / 255.0) * max_value).astype(int)
+        avg_g = ((avg_g / 255.0) * max_value).astype(int)
+        avg_b = ((avg_b / 255.0) * max_value).astype(int)
+
+        # Calculate color variance in block, scale of 0 to 1, based on
+        # actual number of unique colors in block
+        variance = (num_colors / sizes * 10.0).astype(int)
+
+        # Save the averages for each alg type, one value per block. Also
+        # save a scaled count of the number of colors present per block
+        # (used for detail option).
+        self._avg['l'][:] = avg_l.ravel()
+        self._avg['h'][:] = avg_h.ravel()
+        self._avg['s'][:] = avg_s.ravel()
+        self._avg['v'][:] = avg_v.ravel()
+        self._avg['r'][:] = avg_r.ravel()
+        self._avg['g'][:] = avg_g.ravel()
+        self._avg['b'][:] = avg_b.ravel()
+        self._avg['variance'][:] = variance.ravel()
 
     def build_average_lut(self, atype):
         """
@@ -244,61 +515,101 @@ class SourceImage(object):
         :param atype: A string representing the combination of algorithms
         :return: Nothing
         """
-        avg_lut = []
+        variance = self._avg['variance']
+        colors = None
+
         # Process the color-only type separately. The average of r, g and b
         # will be used to sort the list, and will be used to index it later.
+        # The rgb values are kept alongside as their own array.
         if 'c' in atype:
-            for i in range(self._num_blocks):
-                avg_dict = self._avg_list[i]
-                r = avg_dict['r']
-                g = avg_dict['g']
-                b = avg_dict['b']
-                avg = int((float(r) + float(g) + float(b)) / 3.0)
-                variance = avg_dict['variance']
-
-                # Store the original index, avg of r, g and b, and variance
-                # together as a tuple, with the rgb values as their own tuple.
-                # The avg of r, g and b will be used for sorting.
-                avg_lut.append((i, avg, variance, (r, g, b)))
+            colors = np.stack([self._avg['r'], self._avg['g'], self._avg['b']], axis=1)
+            avg = (colors.sum(axis=1) / 3.0).astype(np.int16)
 
         else:
-            for i in range(self._num_blocks):
-                avg_dict = self._avg_list[i]
-                alg_sum = 0.0
-                variance = avg_dict['variance']
-                if ('l' in atype):
-                    alg_sum += avg_dict['l']
-                if ('h' in atype):
-                    alg_sum += avg_dict['h']
-                if ('s' in atype):
-                    alg_sum += avg_dict['s']
-                if ('v' in atype):
-                    alg_sum += avg_dict['v']
-                if ('r' in atype):
-                    alg_sum += avg_dict['r']
-                if ('g' in atype):
-                    alg_sum += avg_dict['g']
-                if ('b' in atype):
-                    alg_sum += avg_dict['b']
-
-                # We store the original index and avg together as a tuple,
-                # because we will need the index to calculate the coordinates
-                # of where this block originally came from. Also save the color
-                # variance as a third value in case we're using the detail
-                # option.
-                avg = int(alg_sum / len(atype))
-                avg_lut.append((i, avg, variance))
-
-        # Sort based on the second element of the tuple (the average).
-        # Sorting is only necessary for the source table but it won't hurt
-        # to sort the destination table as well. Since we're saving the
-        # index, we always know what part of the image each block comes
-        # from.
-        avg_lut.sort(key=lambda tup: tup[1])
+            alg_sum = sum(self._avg[t] for t in 'lhsvrgb' if t in atype)
+            avg = (alg_sum / len(atype)).astype(np.int16)
+
+        # Sort based on the average. Sorting is only necessary for the source
+        # table but it won't hurt to sort the destination table as well. A
+        # stable sort keeps blocks with equal averages in their original order.
+        # We keep the original index of every block alongside its average,
+        # because we will need the index to calculate the coordinates of where
+        # this block originally came from. Also keep the color variance in
+        # case we're using the detail option.
+        order = np.argsort(avg, kind='stable')
+        if colors is not None:
+            colors = colors[order]
 
         # Assign to the internal variable so any other LUT that might have
         # been calculated will be replaced
-        self._avg_lut = avg_lut
+        self._avg_lut = (order, avg[order], variance[order], colors)
+
+    def build_tiles(self, keys, cache=True):
+        """
+        Builds source blocks to paste into the output, each flipped, rotated
+        and resized to fit a destination block. With uniform blocks the same
+        tiles come up again for every type, so they're cached.
+
+        :param keys: List of (src_idx, flip, rotate, width, height) tuples
+        :param cache: False to skip the cache, for when tiles rarely repeat
+        :return: List of tile arrays, one per key
+        """
+        if cache is False:
+            return list(_tile_pool().map(lambda key: self._build_tile(*key), keys))
+
+        tiles = [self._tiles.get(key) for key in keys]
+        missing = [i for i, tile in enumerate(tiles) if tile is None]
+
+        # Building each tile is independent of the others, and Pillow
+        # releases the GIL while resizing, so spread that work over a thread
+        # pool
+        if missing:
+            for i, tile in zip(missing, _tile_pool().map(lambda i: self._build_tile(*keys[i]), missing)):
+                tiles[i] = tile
+
+        for i in missing:
+            if self._tile_bytes + tiles[i].nbytes > _tile_cache_bytes:
+                self._tiles.clear()
+                self._tile_bytes = 0
+            self._tiles[keys[i]] = tiles[i]
+            self._tile_bytes += tiles[i].nbytes
+
+        return tiles
+
+    def _build_tile(self, src_idx, flip, rotate, dest_block_width, dest_block_height):
+        """
+        Builds one block of the output image, sized to fit its destination
+        bounding box.
+
+        :param src_idx: Index of the source block to use
+        :param flip: 0 for no flip, otherwise transpose method + 1
+        :param rotate: 0 for no rotation, otherwise transpose method + 1
+        :param dest_block_width: Width of the destination block
+        :param dest_block_height: Height of the destination block
+        :return: The block as an array
+        """
+        # Calculate the source block bounding box (no size variations)
+        start_x = (src_idx % self._num_cols) * self._block_width
+        start_y = (src_idx // self._num_cols) * self._block_height
+        end_x = start_x + self._block_width
+        end_y = start_y + self._block_height
+
+        # Grab the source image block as a view of the pixel array, then flip
+        # and/or rotate it. These are views too, so nothing is copied until
+        # the block is resized or written to the output.
+        block = self._pixels[start_y:end_y, start_x:end_x]
+        if (flip > 0):
+            block = TRANSPOSES[flip - 1](block)
+        if (rotate > 0):
+            block = TRANSPOSES[rotate - 1](block)
+
+        # If the dest block size is not equal to the source block size, resize
+        # the source block to be the same size as the dest block
+        if (block.shape[1] != dest_block_width) or (block.shape[0] != dest_block_height):
+            src_block = Image.fromarray(np.ascontiguousarray(block))
+            block = np.asarray(src_block.resize((dest_block_width, dest_block_height)))
+
+        return block
 
     @property
     def image(self):
@@ -309,6 +620,15 @@ class SourceImage(object):
         """
         return self._image
 
+    @property
+    def pixels(self):
+        """
+        Returns the image's pixels
+
+        :return: Array of shape (height, width, 3) containing r, g, b values
+        """
+        return self._pixels
+
     @property
     def block_size(self):
         """
@@ -338,23 +658,34 @@ class SourceImage(object):
         """
         return self._row_list, self._col_list
 
+    @property
+    def boundaries(self):
+        """
+        Returns block boundaries as a tuple. Boundaries include the offsets
+        used with the non-uniform option.
+
+        :return: A tuple containing the array of row boundaries and array of column boundaries
+        """
+        return self._row_bounds, self._col_bounds
+
     @property
     def average_lut(self):
         """
-        Returns average lookup table.
+        Returns average lookup table as a tuple of arrays sorted by average.
 
-        :return: Average lookup table (list).
+        :return: A tuple containing the original block indices, averages,
+                 color variances, and rgb values (color-only type, else None)
         """
         return self._avg_lut
 
     @property
     def average_list(self):
         """
-        Returns list of averages.
+        Returns averages.
 
-        :return: Average list (list of dicts).
+        :return: Dict of arrays, one per alg type plus 'variance', indexed by block
         """
-        return self._avg_list
+        return self._avg
 
     @property
     def coordinate_list(self):
@@ -365,6 +696,13 @@ class OutputImage(object):
     """
     Class that creates the final output image.
     """
+    # Saves that have been started but not waited on yet
+    _pending_saves = []
+
+    # Output arrays of images that have been saved, ready to be built into
+    # again
+    _free_arrays = []
+
     def __init__(self, args, user_block_size, atype, is_hdr=False):
         """
         Init method - also creates appropriate output file name.
@@ -375,7 +713,7 @@ class OutputImage(object):
         :param is_hdr: Boolean indicating whether this is an hdr image
         """
         self._atype = atype
-        self._out_file = None
+        self._out_arr = None
         self._med_threshold = args['med_threshold']
         self._small_threshold = args['small_threshold']
         self._is_non_uniform = args['is_non_uniform']
@@ -385,7 +723,7 @@ class OutputImage(object):
 
         # Build the output file name
         if self._is_detail is True:
-            size = "{}".format(self._user_block_size / 2)
+            size = "{}".format(self._user_block_size // 2)
         else:
             size = "{}".format(self._user_block_size)
         head, tail = os.path.split(args['src'])
@@ -393,8 +731,7 @@ class OutputImage(object):
         head, tail = os.path.split(args['dest'])
         dfile, ext = os.path.splitext(tail)
         directory = "output"
-        if not os.path.exists(directory):
-            os.makedirs(directory)
+        os.makedirs(directory, exist_ok=True)
         out_name = "{}/{}_{}_{}".format(directory, dfile, sfile, size)
         if self._is_non_uniform is True:
             out_name = "{}n".format(out_name)
@@ -423,13 +760,8 @@ class OutputImage(object):
         if self._is_detail is True:
             num_passes = 3
 
-        # Grab images, lookup tables and sizes
-        src_img = source_image.image
-
-        src_list = source_image.average_lut
-
-        src_block_width, src_block_height = source_image.block_size
-        src_num_rows, src_num_cols = source_image.rows_cols
+        # Grab lookup tables and sizes
+        src_indices, src_avgs, src_variances, src_colors = source_image.average_lut
 
         # We'll grab this again during the first pass, but we need it here to
         # calculate the output size.
@@ -446,17 +778,13 @@ class OutputImage(object):
         # Should be pretty close to the original size. More cropping can occur
         # if this is a detail image because three passes need to fit in one
         # size.
-        self._out_file = Image.new("RGB", (output_size_x, output_size_y))
+        # The output is kept as an array and only becomes an Image when it's
+        # saved. The first pass draws every block, so an array left over from
+        # an earlier image doesn't need clearing.
+        self._out_arr = OutputImage._take_array((output_size_y, output_size_x, 3))
 
         # Get the number of source image blocks
-        src_num_blocks = len(src_list)
-
-        # These multipliers make it possible for us to avoid an if statement
-        # inside the loop. If hdr, multiply the 'scale * i' assignment by 1 and
-        # the other by 0, otherwise the opposite. That way we only get one
-        # value or the other.
-        scale_mult = int(self._is_hdr)
-        dest_mult = int(not self._is_hdr)
+        src_num_blocks = len(src_indices)
 
         # Create a list of variable dicts that will change with each pass.
         temp_list = [{}, {}, {}]
@@ -467,28 +795,23 @@ class OutputImage(object):
         temp_list[1]['threshold'] = self._small_threshold
         temp_list[2]['threshold'] = 0
 
-        # Each pass will check against the skip list built in the previous pass
-        last_skip_list = None
+        # Each pass will check against the blocks skipped in the previous pass
+        last_skipped = None
 
         for p in range(num_passes):
 
             current_dest_image = temp_list[p]['dest_image']
             current_threshold = temp_list[p]['threshold']
 
-            src_block = None
-
-            # Get increment lists from the destination image
-            row_list, col_list = current_dest_image.offset_lists
-            current_row_list = row_list
-            current_col_list = col_list
+            # Get block boundaries from the destination image
+            current_row_bounds, current_col_bounds = current_dest_image.boundaries
 
             # Save rows and columns (only columns is used)
-            rows, cols = current_dest_image.rows_cols
-            current_cols = cols
+            current_rows, current_cols = current_dest_image.rows_cols
 
             # Get the destination lookup table
-            current_dest_lut = current_dest_image.average_lut
-            current_num_blocks = len(current_dest_lut)
+            dest_indices, dest_avgs, dest_variances, dest_colors = current_dest_image.average_lut
+            current_num_blocks = len(dest_indices)
 
             # Create a coordinate lookup list based on whether the hdr option
             # is on or off. If off, we look up the corresponding memory block
@@ -500,115 +823,190 @@ class OutputImage(object):
             # luminance values will not correspond to indices in the memory
             # list in this case, but this ensures that each block in the memory
             # list will be used.
-            current_scale = 1.0 / current_num_blocks * src_num_blocks
-
-            # Create a list of indices where the color variance is 0. This will
-            # be the blocks we skip in the detail passes, if we're using them.
-            skip_list = []
-
-            # Add the block size for this pass
-            current_block_size = int(self._user_block_size / (2 ** p))
-
-            for i in range(current_num_blocks):
-                j = (int(current_scale * i) * scale_mult) + \
-                    (int(current_dest_lut[i][1]) * dest_mult)
-
-                # Grab the source and destination list indices
-                src_idx = src_list[j][0]
-                dest_idx = current_dest_lut[i][0]
-
-                # Grab the color variance of the block. If it's below the
-                # threshold we'll save it to the list to be skipped in future
-                # passes.
-                variance = current_dest_lut[i][2]
-
-                # PASS > 0
-                # Work backwards to find the index of the larger block that
-                # contains this smaller one. Division by 0 is not an issue
-                # because this won't run on pass 0
-                if last_skip_list is not None:
-                    y = dest_idx / (current_cols * (2))
-                    x = (dest_idx % current_cols) / (2)
-                    outeridx = (y * (current_cols / 2)) + x
-
-                    if outeridx in last_skip_list:
-                        skip_list.append(dest_idx)
-                        continue
-
-                if variance < current_threshold:
-                    skip_list.append(dest_idx)
-
-                # For the color-only type, we'll fill the destination block
-                # with a solid color. For all others, we'll paste a block from
-                # the source image.
-                if 'c' not in self._atype:
-
-                    # Calculate the source block bounding box (no size
-                    # variations)
-                    start_x = int(src_idx % src_num_cols) * src_block_width
-                    start_y = int(src_idx / src_num_cols) * src_block_height
-                    end_x = start_x + src_block_width
-                    end_y = start_y + src_block_height
-
-                    # Grab the source image blocks
-                    src_block = src_img.crop((start_x, start_y, end_x, end_y))
-
-                    # Randomly determine whether this block will be flipped
-                    # and/or rotated
-                    flip = randint(0, 2)
-                    rotate = randint(0, 3)
-                    if (flip > 0):
-                        src_block = src_block.transpose(flip - 1)
-                    if (rotate > 0):
-                        src_block = src_block.transpose(rotate - 1)
-
-                # Calculate destination block position and size
-                col = int(dest_idx % current_cols)
-                row = int(dest_idx / current_cols)
-                start_x = col * current_block_size
-                start_y = row * current_block_size
-                end_x = start_x + current_block_size
-                end_y = start_y + current_block_size
-
-                # Calculate block uniformity. We have to look at the current
-                # value and the next one, which correspond to the start and
-                # end values respectively. The offsets will be all 0's if
-                # uniform blocks are used.
-                start_x += current_col_list[col]
-                end_x += current_col_list[col + 1]
-                start_y += current_row_list[row]
-                end_y += current_row_list[row + 1]
-
-                # Calculate the block's dimensions. Will be different each time
-                # if non-uniform is used.
-                dest_block_width = end_x - start_x
-                dest_block_height = end_y - start_y
-
-                if 'c' in self._atype:
-                    rgb = src_list[j][3]
-                    src_block = Image.new("RGB",
-                                          (dest_block_width, dest_block_height),
-                                          rgb)
+            # The lookups for every block are worked out up front so the
+            # block loop doesn't need to branch on hdr. The hdr scaling is done
+            # in integers, which is exact where a float scale can drift.
+            if self._is_hdr is True:
+                j_list = (np.arange(current_num_blocks) * src_num_blocks) // current_num_blocks
+            else:
+                j_list = dest_avgs
+
+            # The lookups are in average order, which jumps all over the
+            # output. Put them back in block order so the output array is
+            # written row by row, front to back.
+            order = np.argsort(dest_indices)
+            dest_indices = dest_indices[order]
+            dest_variances = dest_variances[order]
+            j_list = j_list[order]
+
+            # Grab the source block index for every destination block, and the
+            # row and column of every destination block
+            src_idx_list = src_indices[j_list]
+            dest_rows, dest_cols = np.divmod(dest_indices, current_cols)
+
+            # PASS > 0
+            # Work backwards to find the index of the larger block that
+            # contains each smaller one. The row and column of the larger
+            # block are half of this block's. Blocks inside a larger block
+            # that was skipped in the last pass aren't drawn. Division by 0 is
+            # not an issue because this won't run on pass 0
+            if last_skipped is not None:
+                outer_idx = (dest_rows // 2) * (current_cols // 2) + (dest_cols // 2)
+                drawn = ~last_skipped[outer_idx]
+            else:
+                drawn = np.ones(current_num_blocks, dtype=bool)
+
+            # Mark the blocks to be skipped in future passes, indexed by block:
+            # those not drawn, and those with a color variance below the
+            # threshold.
+            skipped = np.zeros(current_num_blocks, dtype=bool)
+            skipped[dest_indices] = ~drawn | (dest_variances < current_threshold)
+
+            # For the color-only type, we'll fill the destination blocks with
+            # solid colors, all at once. The lookups are in block order, so
+            # they line up with the boundaries.
+            if 'c' in self._atype:
+                self._paint_colors(src_colors[j_list], drawn, current_row_bounds, current_col_bounds)
+
+            # For all others, we'll paste a block from the source image,
+            # randomly flipped and/or rotated.
+            else:
 
+                # Calculate destination block positions and sizes. We have to
+                # look at the current boundary and the next one, which
+                # correspond to the start and end values respectively. The
+                # offsets in them will be all 0's if uniform blocks are used.
+                dest_boxes = np.stack([current_col_bounds[dest_cols],
+                                       current_row_bounds[dest_rows],
+                                       current_col_bounds[dest_cols + 1],
+                                       current_row_bounds[dest_rows + 1]], axis=1)
+
+                # Random flips and rotations for every block are picked in
+                # one go here, so the worker threads below don't share the
+                # random generator.
+                flips = np.random.randint(0, 3, size=current_num_blocks)
+                rotates = np.random.randint(0, 4, size=current_num_blocks)
+
+                # Many blocks use the same source block with the same flip,
+                # rotation and size. Build each of those combinations once
+                # and copy it to every block that needs it.
+                sizes = dest_boxes[:, 2:] - dest_boxes[:, :2]
+                keys = np.column_stack([src_idx_list, flips, rotates, sizes])[drawn]
+                keys, key_list = np.unique(keys, axis=0, return_inverse=True)
+                # Non-uniform block sizes vary too much for tiles to repeat
+                blocks = source_image.build_tiles([tuple(key) for key in keys.tolist()],
+                                                  cache=self._is_non_uniform is False)
+
+                # With uniform blocks, the output can be viewed as a grid of
+                # blocks, and all the tiles go in with one assignment.
+                # Otherwise each block is copied to its own box.
+                key_list = key_list.ravel()
+                heights = np.diff(current_row_bounds)
+                widths = np.diff(current_col_bounds)
+                if (heights == heights[0]).all() and (widths == widths[0]).all():
+                    grid = self._out_arr[:current_row_bounds[-1], :current_col_bounds[-1]]
+                    grid = grid.reshape(current_rows, heights[0], current_cols, widths[0], 3)
+                    grid = grid.swapaxes(1, 2)
+                    grid[dest_rows[drawn], dest_cols[drawn]] = np.stack(blocks)[key_list]
                 else:
+                    for box, k in zip(dest_boxes[drawn].tolist(), key_list.tolist()):
+                        start_x, start_y, end_x, end_y = box
+                        self._out_arr[start_y:end_y, start_x:end_x] = blocks[k]
 
-                    # If the dest block size is not equal to the source block
-                    # size, resize the source block to be the same size as the
-                    # dest block
-                    if (src_block_width != dest_block_width) or (src_block_height != dest_block_height):
-                        src_block = src_block.resize((dest_block_width, dest_block_height))
-
-                # Paste the memory block into the correct coordinates of
-                # the output file
-                self._out_file.paste(src_block, (start_x, start_y))
+            last_skipped = skipped
 
-            last_skip_list = skip_list
+    def _paint_colors(self, colors, drawn, row_bounds, col_bounds):
+        """
+        Fills the drawn blocks of the output image with solid colors. Works a
+        row of blocks at a time: the colors and drawn flags are stretched out
+        to pixel columns once, then copied down every pixel row of the block
+        row.
+
+        :param colors: (r, g, b) array with one color per block, in block order
+        :param drawn: Boolean array marking the blocks to fill, in block order
+        :param row_bounds: Row boundaries, one longer than the number of rows
+        :param col_bounds: Column boundaries, one longer than the number of columns
+        :return: Nothing
+        """
+        num_cols = len(col_bounds) - 1
+        widths = np.diff(col_bounds)
+        colors = np.clip(colors, 0, 255).astype(np.uint8).reshape(-1, num_cols, 3)
+        drawn = drawn.reshape(-1, num_cols)
+
+        for row in range(len(row_bounds) - 1):
+            row_mask = np.repeat(drawn[row], widths)
+            if not row_mask.any():
+                continue
+            row_pixels = np.repeat(colors[row], widths, axis=0)
+            band = self._out_arr[row_bounds[row]:row_bounds[row + 1], col_bounds[0]:col_bounds[-1]]
+            band[:, row_mask] = row_pixels[row_mask]
 
     def save_image(self):
         """
-        Saves the output image to disk.
+        Saves the output image to disk in the background, so the next image
+        can be built while this one is encoded and written. Call wait_all
+        before exiting.
+
+        :return: Future for the save
+        """
+        # Don't let finished images pile up in memory faster than they can be
+        # written
+        while len(OutputImage._pending_saves) >= MAX_PENDING_SAVES:
+            OutputImage._finish_save(OutputImage._pending_saves.pop(0))
+
+        future = _SAVE_POOL.submit(self._write_image)
+        OutputImage._pending_saves.append(future)
+        return future
+
+    def _write_image(self):
+        """
+        Writes the output image to disk.
+
+        :return: Name of the file written
+        """
+        Image.fromarray(self._out_arr).save(self._out_name, "TIFF")
+
+        # The array isn't needed once it's written, so hand it to the next
+        # image of the same size
+        OutputImage._free_arrays.append(self._out_arr)
+        self._out_arr = None
+        return self._out_name
+
+    @staticmethod
+    def _finish_save(future):
+        """
+        Waits for a background save and reports it. Reporting happens here
+        rather than on the save thread, and as a single write, so messages
+        from other threads and worker processes don't run together.
+
+        :param future: Future for the save
+        :return: Nothing
+        """
+        sys.stdout.write("Saved {}\n".format(future.result()))
+        sys.stdout.flush()
+
+    @classmethod
+    def _take_array(cls, shape):
+        """
+        Returns an output array, reusing one from an image that has already
+        been saved if one of the same shape is free. Its contents are left
+        as they are.
+
+        :param shape: Shape of the array
+        :return: Array of the given shape
+        """
+        for i, arr in enumerate(cls._free_arrays):
+            if arr.shape == shape:
+                return cls._free_arrays.pop(i)
+        return np.zeros(shape, dtype=np.uint8)
+
+    @classmethod
+    def wait_all(cls):
+        """
+        Waits for all background saves to finish. Any error raised while
+        saving is raised here.
 
         :return: Nothing
         """
-        self._out_file.save(self._out_name, "TIFF")
-        print ("Saved {}".format(self._out_name))
+        while cls._pending_saves:
+            cls._finish_save(cls._pending_saves.pop(0))
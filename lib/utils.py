@@ -1,23 +1,23 @@
 import itertools
+from functools import lru_cache
 
+import numpy as np
 
+
+@lru_cache(maxsize=64)
 def build_algorithm_list(opts):
     """
-    Builds a list of algorithm options
+    Builds a list of algorithm options. Results are cached, so they are
+    returned as tuples that can't be changed by the caller.
 
     :param opts: Algorithm type flags joined together into one string
-    :return: All possible algorithm type flag combinations in list form
+    :return: All possible algorithm type flag combinations in tuple form
     """
-    algs = []
-    for i in range(1, len(opts)+1):
-        for subset in itertools.combinations(opts, i):
-            st = ''
-            for char in subset:
-                st = "{}{}".format(st, char)
-            algs.append(st)
-                      
-    return algs
-    
+    return tuple(''.join(subset)
+                 for i in range(1, len(opts) + 1)
+                 for subset in itertools.combinations(opts, i))
+
+
 def rgb_to_hsv(r, g, b):
     """
     Converts RGB data to HSV
@@ -52,3 +52,34 @@ def rgb_to_hsv(r, g, b):
         h += 360.0
         
     return h, s, v
+
+
+def rgb_to_hsv_array(rgb):
+    """
+    Converts an array of RGB data to HSV. Same math as rgb_to_hsv, applied to
+    every element at once.
+
+    :param rgb: Array of shape (..., 3) containing R, G, B components
+    :return: A tuple containing arrays of the resulting H, S, V components
+    """
+    rgb = np.asarray(rgb, dtype=np.float64)
+    r = rgb[..., 0]
+    g = rgb[..., 1]
+    b = rgb[..., 2]
+    max_rgb = rgb.max(axis=-1)
+    min_rgb = rgb.min(axis=-1)
+    v = max_rgb
+    delta = max_rgb - min_rgb
+
+    # Swap in 1's where we would divide by 0. Those results are masked out.
+    s = np.where(max_rgb > 0, delta / np.where(max_rgb > 0, max_rgb, 1.0), 0.0)
+    safe_delta = np.where(delta > 0, delta, 1.0)
+
+    h = np.select([r == max_rgb, g == max_rgb],
+                  [(g - b) / safe_delta,              # between yellow & magenta
+                   2 + (b - r) / safe_delta],         # between cyan & yellow
+                  4 + (r - g) / safe_delta)           # between magenta & cyan
+    h = np.where(delta > 0, h * 60.0, 0.0)            # degrees
+    h = np.where(h < 0.0, h + 360.0, h)
+
+    return h, s, v
@@ -9,10 +9,27 @@ accepts two images as input. See README.md for detailed usage instructions.
 
 import argparse
 import os.path
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_start_method
 from sys import stderr
 
-from lib import utils
-from lib.image import SourceImage, OutputImage
+
+# Images and settings shared by every render. Filled in by init_render, in
+# the main process or in each worker process.
+render_state = {}
+
+
+def existing_file(file_name):
+    """
+    Argument type for input files. Pillow will check that they're valid
+    images.
+
+    :param file_name: File name given on the command line
+    :return: The file name, if the file exists
+    """
+    if not os.path.isfile(file_name):
+        raise argparse.ArgumentTypeError("invalid file '{}'".format(file_name))
+    return file_name
 
 
 def process_args():
@@ -26,8 +43,10 @@ def process_args():
     parser = argparse.ArgumentParser(description='Rebuilds one image from another image')
 
     parser.add_argument("source_image",
+                        type=existing_file,
                         help="Source image file")
     parser.add_argument("dest_image",
+                        type=existing_file,
                         help="Destination image file (the image to rebuild using source_image)")
     parser.add_argument("-b",
                         action="store",
@@ -42,7 +61,7 @@ def process_args():
                         help="Type (l, h, s, v, r, g, b or combination)")
     parser.add_argument("-c",
                         action="store_true",
-                        default="False",
+                        default=False,
                         dest="do_color",
                         help="Color-only processing")
     parser.add_argument("-n",
@@ -67,6 +86,12 @@ def process_args():
                         type=int,
                         dest="small_threshold",
                         help="High res color variance threshold (1-10, default = 8)")
+    parser.add_argument("-w",
+                        action="store",
+                        default=os.cpu_count() or 1,
+                        type=int,
+                        dest="workers",
+                        help="Number of worker processes (default = number of CPUs)")
 
     options = parser.parse_args()
 
@@ -76,13 +101,7 @@ def process_args():
     temp_type = options.type
     temp_med_threshold = options.med_threshold
     temp_small_threshold = options.small_threshold
-
-    # Check for valid files. Pillow will check that they're valid images.
-    if not os.path.isfile(options.source_image):
-        raise SystemExit("ERROR: Invalid source file '{}'.\n".format(options.source_image))
-
-    if not os.path.isfile(options.dest_image):
-        raise SystemExit("ERROR: Invalid destination file '{}'.\n".format(options.dest_image))
+    temp_workers = options.workers
 
     # Make sure we have a workable block size
     if options.is_detail is True:
@@ -118,26 +137,100 @@ def process_args():
             temp_small_threshold = 8
             stderr.write("WARNING: Small threshold out of 1-10 range, set to '{}'.\n".format(temp_small_threshold))
 
+    # Check number of workers
+    if temp_workers < 1:
+        temp_workers = 1
+        stderr.write("WARNING: Number of workers too small. Clamped to '{}'.\n".format(temp_workers))
 
     # Set filenames and additional options
     rebld_args['src'] = options.source_image
     rebld_args['dest'] = options.dest_image
 
     rebld_args['block_size'] = temp_block_size
-    rebld_args['type'] = type_dict.keys()
+    rebld_args['type'] = list(type_dict)
     rebld_args['do_color'] = options.do_color
     rebld_args['is_non_uniform'] = options.is_non_uniform
     rebld_args['is_detail'] = options.is_detail
     rebld_args['med_threshold'] = temp_med_threshold
     rebld_args['small_threshold'] = temp_small_threshold
+    rebld_args['workers'] = temp_workers
 
     return rebld_args
-    
-    
+
+
+def init_render(state):
+    """
+    Stores the images and settings every render needs. Used as the process
+    pool initializer, so the images are handed over once per worker instead
+    of once per type.
+
+    :param state: Dict of images and settings shared by every render
+    :return: Nothing
+    """
+    import numpy as np
+    from lib import image
+
+    render_state.update(state)
+    image.set_process_count(state['workers'])
+
+    # Forked workers start with a copy of the parent's random state. Reseed
+    # so each one flips and rotates blocks differently.
+    np.random.seed()
+
+
+def render(atype):
+    """
+    Builds and saves the hdr and non-hdr output images for one type.
+
+    :param atype: Algorithm type combination, or 'c' for color-only
+    :return: Nothing
+    """
+    from lib.image import OutputImage
+
+    args = render_state['args']
+    user_block_size = render_state['user_block_size']
+    source = render_state['source']
+    dest = render_state['dest']
+    dest_med = render_state['dest_med']
+    dest_high = render_state['dest_high']
+
+    # Create the output based on the current algorithm
+    output = OutputImage(args, user_block_size, atype)
+    output_hdr = OutputImage(args, user_block_size, atype, True)
+
+    # Lookups change for each algorithm. They're a little different for the
+    # color-only type.
+    source.build_average_lut(atype)
+    dest.build_average_lut(atype)
+
+    # Build hdr and non-hdr versions
+    if args['is_detail'] is True:
+        dest_med.build_average_lut(atype)
+        dest_high.build_average_lut(atype)
+        output.build_image(source, dest, dest_med, dest_high)
+        output_hdr.build_image(source, dest, dest_med, dest_high)
+    else:
+        output.build_image(source, dest)
+        output_hdr.build_image(source, dest)
+
+    # Save the output images. Wait for them here, since a worker process
+    # can't be waited on once it's done.
+    output.save_image()
+    output_hdr.save_image()
+    OutputImage.wait_all()
+
+
 if __name__ == '__main__':
 
     # Process arguments
     args = process_args()
+
+    # NumPy, Pillow and the image code take most of the startup time, so
+    # they're only loaded once the arguments check out. The functions above
+    # import what they need themselves, since worker processes don't run
+    # this block.
+    from lib import utils
+    from lib.image import SourceImage, OutputImage
     
     # Set up some variables
     source_name = args['src']
@@ -151,18 +244,15 @@ if __name__ == '__main__':
     
     # Build the algorithm list
     opts = 'lhsvrgb'
-    if len(args['type']) == 1:
-        algs = args['type'] 
-    elif len(args['type']) > 1:
-        algs = utils.build_algorithm_list(args['type'])
+    # If color-only is specified and type is not given, this is allowed.
+    # But if color-only is off and type is not specified, load all the
+    # types by default. Either way algs is a tuple of type strings.
+    if len(args['type']) > 0:
+        algs = utils.build_algorithm_list(''.join(args['type']))
+    elif do_color is True:
+        algs = ()
     else:
-        # If color-only is specified and type is not given, this is allowed.
-        # But if color-only is off and type is not specified, load all the 
-        # types by default.
-        if do_color is True:
-            algs = []
-        else:
-            algs = utils.build_algorithm_list(opts)
+        algs = utils.build_algorithm_list(opts)
     
     # Two extra destination images will be used if detail flag is set
     dest_med = None
@@ -174,7 +264,7 @@ if __name__ == '__main__':
         
         # We'll need additional block sizes for the other two images
         # we'll pull from.
-        user_block_size_high = int(user_block_size / 2)
+        user_block_size_high = user_block_size // 2
         user_block_size_med = user_block_size
         user_block_size = user_block_size * 2
         
@@ -194,19 +284,31 @@ if __name__ == '__main__':
     src_rows, src_cols = source.rows_cols
     max_value = (src_rows * src_cols) - 1
     
+    # Uniform detail layers line up with each other: every block of the main
+    # and medium layers is made of 4x4 and 2x2 high res blocks. Their
+    # averages are all built from the high res layer further down.
+    fuse_detail = is_detail is True and is_non_uniform is False
+
+    # Only the channels used by the types being processed need averages.
+    # Color-only uses r, g and b.
+    channels = ''.join(algs)
+    if do_color is True:
+        channels += 'rgb'
+
     # Average lists are straightforward
     print ("Calculating averages...")
-    source.build_average_list(max_value)
-    dest.build_average_list(max_value)
+    source.build_average_list(max_value, channels=channels)
+    if fuse_detail is False:
+        dest.build_average_list(max_value, channels=channels)
         
     # Repeat the above process for the additional detail images
     if is_detail is True:
 
         # Create the additional image instances. We'll use the actual image
-        # from the first destination image created so we don't open the same
-        # file three times.
-        dest_med = SourceImage.from_image(dest.image, is_non_uniform, is_detail)
-        dest_high = SourceImage.from_image(dest.image, is_non_uniform, is_detail)
+        # and pixels from the first destination image created so we don't
+        # open or convert the same file three times.
+        dest_med = SourceImage.from_source_image(dest, is_non_uniform, is_detail)
+        dest_high = SourceImage.from_source_image(dest, is_non_uniform, is_detail)
         
         # We need to sync up the final image size with the main destination 
         # image. We'll use width and height overrides when calculating blocks 
@@ -222,63 +324,52 @@ if __name__ == '__main__':
         # Build the average lists for each, using the maxValue calculated from
         # the common source image number of blocks
         print ("Calculating averages for detail layers...")
-        dest_med.build_average_list(max_value)
-        dest_high.build_average_list(max_value)
+        if fuse_detail is True:
+            dest_high.build_average_list(max_value, (dest_med, dest), channels)
+        else:
+            dest_med.build_average_list(max_value, channels=channels)
+            dest_high.build_average_list(max_value, channels=channels)
             
     # Iterate through the image types and combinations we're processing and
-    # create output images
+    # create output images. The color-only type is processed the same way,
+    # after the others.
     if len(algs) > 0:
         print ("Processing types and combinations...")
-        
-    for atype in algs:
-        
-        # Create the output based on the current algorithm
-        output = OutputImage(args, user_block_size, atype)
-        output_hdr = OutputImage(args, user_block_size, atype, True)
-        
-        # Lookups change for each algorithm
-        source.build_average_lut(atype)
-        dest.build_average_lut(atype)
-        
-        # Build hdr and non-hdr versions
-        if is_detail is True:
-            dest_med.build_average_lut(atype)
-            dest_high.build_average_lut(atype)
-            output.build_image(source, dest, dest_med, dest_high)
-            output_hdr.build_image(source, dest, dest_med, dest_high)
-        else:
-            output.build_image(source, dest)
-            output_hdr.build_image(source, dest)
-                
-        # Save the output images
-        output.save_image()
-        output_hdr.save_image()
-        
-    # Do the color-only processing, if requested
     if do_color is True:
-        
         print ("Processing color-only option...")
-        
-        # Create the output for the color images
-        output = OutputImage(args, user_block_size, 'c')
-        output_hdr = OutputImage(args, user_block_size, 'c', True)
-        
-        # Lookups are a little different for this type
-        source.build_average_lut('c')
-        dest.build_average_lut('c')
-        
-        # Build hdr and non-hdr versions
-        if is_detail is True:
-            dest_med.build_average_lut('c')
-            dest_high.build_average_lut('c')
-            output.build_image(source, dest, dest_med, dest_high)
-            output_hdr.build_image(source, dest, dest_med, dest_high)
-        else:
-            output.build_image(source, dest)
-            output_hdr.build_image(source, dest)
-        
-        # Save the output images
-        output.save_image()
-        output_hdr.save_image()
-                    
+        algs = algs + ('c',)
+
+    # Each type is independent of the others once the averages are built, so
+    # spread them over a pool of worker processes
+    state = {'args': args,
+             'user_block_size': user_block_size,
+             'source': source,
+             'dest': dest,
+             'dest_med': dest_med,
+             'dest_high': dest_high}
+    workers = min(args['workers'], len(algs))
+    state['workers'] = workers
+    if workers > 1:
+
+        # Put the pixels in shared memory so workers don't each get a copy.
+        # Forked workers already share the parent's memory, so sharing would
+        # only add another copy of every image.
+        shared = []
+        if get_start_method() != 'fork':
+            detail_images = [image for image in (dest_med, dest_high) if image is not None]
+            shared = [source.share_pixels(), dest.share_pixels(*detail_images)]
+        try:
+            with ProcessPoolExecutor(max_workers=workers, initializer=init_render, initargs=(state,)) as pool:
+                list(pool.map(render, algs))
+        finally:
+            for shm in shared:
+                shm.unlink()
+    else:
+        init_render(state)
+        for atype in algs:
+            render(atype)
+
+    # Make sure every output image has been written
+    OutputImage.wait_all()
+
     print ("Finished!")
@@ -0,0 +1,30 @@
+import pickle
+import unittest
+
+import numpy as np
+import PIL.Image as Image
+
+from lib.image import SourceImage
+
+
+class SourceImageTest(unittest.TestCase):
+
+    def test_shared_pixels_survive_pickling(self):
+        pixels = np.random.randint(0, 256, (40, 60, 3), dtype=np.uint8)
+        source = SourceImage.from_image(Image.fromarray(pixels))
+        shm = source.share_pixels()
+        try:
+            copy = pickle.loads(pickle.dumps(source))
+            self.assertTrue(np.array_equal(copy.pixels, pixels))
+
+            # The copy must keep the block mapped on its own
+            del source
+            self.assertTrue(np.array_equal(copy.pixels, pixels))
+            del copy
+        finally:
+            shm.close()
+            shm.unlink()
+
+
+if __name__ == '__main__':
+    unittest.main()